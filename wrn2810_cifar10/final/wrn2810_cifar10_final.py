@@ -1,19 +1,20 @@
+import math
 import os
 import random
 import tempfile
 
+import numba
 import numpy as np
+import tensorflow as tf
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from PIL import Image, ImageEnhance, ImageOps, ImageTransform
 
 import fastestimator as fe
-from fastestimator.dataset.data import cifar10
+from fastestimator.dataset import NumpyDataset
 from fastestimator.op.numpyop import NumpyOp
-from fastestimator.op.numpyop.meta import OneOf, Sometimes
-from fastestimator.op.numpyop.multivariate import HorizontalFlip, PadIfNeeded, RandomCrop
-from fastestimator.op.numpyop.univariate import ChannelTranspose, CoarseDropout, Normalize
+from fastestimator.op.numpyop.multivariate import PadIfNeeded, RandomCrop
+from fastestimator.op.tensorop import TensorOp
 from fastestimator.op.tensorop.loss import CrossEntropy
 from fastestimator.op.tensorop.model import ModelOp, UpdateOp
 from fastestimator.schedule import cosine_decay
@@ -34,8 +35,8 @@ class BasicBlock(nn.Module):
         self.conv2 = nn.Conv2d(out_planes, out_planes, kernel_size=3, stride=1, padding=1, bias=False)
         self.droprate = dropRate
         self.equalInOut = (in_planes == out_planes)
-        self.convShortcut = (not self.equalInOut) and nn.Conv2d(
-            in_planes, out_planes, kernel_size=1, stride=stride, padding=0, bias=False) or None
+        self.convShortcut = None if self.equalInOut else nn.Conv2d(
+            in_planes, out_planes, kernel_size=1, stride=stride, padding=0, bias=False)
 
     def forward(self, x):
         if not self.equalInOut:
@@ -46,7 +47,8 @@ class BasicBlock(nn.Module):
         if self.droprate > 0:
             out = F.dropout(out, p=self.droprate, training=self.training)
         out = self.conv2(out)
-        return torch.add(x if self.equalInOut else self.convShortcut(x), out)
+        shortcut = x if self.equalInOut else self.convShortcut(x)
+        return out.add_(shortcut)
 
 
 class NetworkBlock(nn.Module):
@@ -57,7 +59,7 @@ class NetworkBlock(nn.Module):
     def _make_layer(self, block, in_planes, out_planes, nb_layers, stride, dropRate):
         layers = []
         for i in range(int(nb_layers)):
-            layers.append(block(i == 0 and in_planes or out_planes, out_planes, i == 0 and stride or 1, dropRate))
+            layers.append(block(in_planes if i == 0 else out_planes, out_planes, stride if i == 0 else 1, dropRate))
         return nn.Sequential(*layers)
 
     def forward(self, x):
@@ -93,30 +95,32 @@ class WideResNet(nn.Module):
                 m.bias.data.zero_()
             elif isinstance(m, nn.Linear):
                 m.bias.data.zero_()
+        # NHWC lets cuDNN pick its tensor core convolution kernels
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         out = self.conv1(x)
         out = self.block1(out)
         out = self.block2(out)
         out = self.block3(out)
         out = self.relu(self.bn1(out))
-        out = F.avg_pool2d(out, 8, 1)
+        out = F.adaptive_avg_pool2d(out, 1)
         out = out.view(-1, self.nChannels)
         return self.fc(out)
 
 
-class Rotate(NumpyOp):
-    """ rotate between 0 to 90 degree
-    """
-    def __init__(self, level, inputs=None, outputs=None, mode=None):
-        super().__init__(inputs=inputs, outputs=outputs, mode=mode)
-        self.degree = level * 3.0
-
-    def forward(self, data, state):
-        im = Image.fromarray(data)
-        degree = random.uniform(-self.degree, self.degree)
-        im = im.rotate(degree)
-        return np.copy(np.asarray(im))
+def compile_model(model):
+    # torch.compile only exists from PyTorch 2.0, older versions keep running eagerly. With several GPUs fe.build wraps
+    # the model in DataParallel, whose replicas copy the module __dict__ and would all call the original's compiled code
+    if not hasattr(torch, "compile") or torch.cuda.device_count() > 1:
+        return model
+    if hasattr(model, "compile"):
+        # PyTorch 2.2+ compiles in place, so FE keeps the original module and its state_dict keys
+        model.compile(mode="reduce-overhead")
+    else:
+        model.forward = torch.compile(model.forward, mode="reduce-overhead")
+    return model
 
 
 class Identity(NumpyOp):
@@ -129,9 +133,12 @@ class AutoContrast(NumpyOp):
         super().__init__(inputs=inputs, outputs=outputs, mode=mode)
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
-        im = ImageOps.autocontrast(im)
-        return np.copy(np.asarray(im))
+        lo = data.min(axis=(0, 1)).astype(np.float64)
+        hi = data.max(axis=(0, 1)).astype(np.float64)
+        # stretch every channel to [0, 255] with the lookup formula of ImageOps.autocontrast, flat channels are kept
+        scale = np.where(hi > lo, 255.0 / np.maximum(hi - lo, 1), 1.0)
+        offset = np.where(hi > lo, -lo * scale, 0.0)
+        return np.clip(data * scale + offset, 0, 255).astype(np.uint8)
 
 
 class Equalize(NumpyOp):
@@ -139,9 +146,16 @@ class Equalize(NumpyOp):
         super().__init__(inputs=inputs, outputs=outputs, mode=mode)
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
-        im = ImageOps.equalize(im)
-        return np.copy(np.asarray(im))
+        # same lookup table as ImageOps.equalize, built per channel from its histogram
+        luts = np.empty((data.shape[-1], 256), dtype=np.uint8)
+        for c in range(data.shape[-1]):
+            hist = np.bincount(data[..., c].ravel(), minlength=256)
+            step = (hist.sum() - hist[np.flatnonzero(hist)[-1]]) // 255
+            if step == 0:
+                luts[c] = np.arange(256)
+            else:
+                luts[c] = np.minimum((np.cumsum(hist) - hist + step // 2) // step, 255)
+        return luts[np.arange(data.shape[-1]), data]
 
 
 class Posterize(NumpyOp):
@@ -151,10 +165,18 @@ class Posterize(NumpyOp):
         self.bit_loss_limit = level / 30 * 7
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
         bits_to_keep = 8 - round(random.uniform(0, self.bit_loss_limit))
-        im = ImageOps.posterize(im, bits_to_keep)
-        return np.copy(np.asarray(im))
+        return data & np.uint8((0xFF << (8 - bits_to_keep)) & 0xFF)
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _solarize(data, threshold):
+    for i in range(data.shape[0]):
+        x = data[i]
+        data[i] = x if x < threshold else 255 - x
+
+
+_solarize(np.zeros(3, dtype=np.uint8), 256)  # warm up the jit cache at import
 
 
 class Solarize(NumpyOp):
@@ -165,20 +187,40 @@ class Solarize(NumpyOp):
 
     def forward(self, data, state):
         threshold = 256 - round(random.uniform(0, self.loss_limit))
-        data = np.where(data < threshold, data, 255 - data)
+        # solarize in place, the array is a fresh per-sample copy produced by the crop or a previous op
+        data = np.require(data, requirements=["C", "W"])
+        _solarize(data.reshape(-1), threshold)
         return data
 
 
+def _grayscale(data):
+    # ITU-R 601-2 luma with the same fixed-point rounding as Image.convert("L")
+    data = data.astype(np.int32)
+    return ((data[..., 0] * 19595 + data[..., 1] * 38470 + data[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+
+def _blend(degenerate, data, factor):
+    # Image.blend(degenerate, data, factor), which is what every ImageEnhance enhancer returns
+    degenerate = np.asarray(degenerate, dtype=np.float32)
+    blended = degenerate + np.float32(factor) * (data.astype(np.float32) - degenerate)
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+
 class Sharpness(NumpyOp):
     def __init__(self, level, inputs=None, outputs=None, mode=None):
         super().__init__(inputs=inputs, outputs=outputs, mode=mode)
         self.diff_limit = level / 30 * 0.9
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
         factor = 1.0 + random.uniform(-self.diff_limit, self.diff_limit)
-        im = ImageEnhance.Sharpness(im).enhance(factor)
-        return np.copy(np.asarray(im))
+        image = data.astype(np.int32)
+        # ImageFilter.SMOOTH: 3x3 kernel weighting the center 5 and its neighbours 1, rounded to the nearest integer,
+        # border pixels are kept
+        degenerate = image.copy()
+        height, width = image.shape[:2]
+        window_sum = sum(image[i:height - 2 + i, j:width - 2 + j] for i in range(3) for j in range(3))
+        degenerate[1:-1, 1:-1] = (2 * (window_sum + 4 * image[1:-1, 1:-1]) + 13) // 26
+        return _blend(degenerate, image, factor)
 
 
 class Contrast(NumpyOp):
@@ -187,10 +229,8 @@ class Contrast(NumpyOp):
         self.diff_limit = level / 30 * 0.9
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
         factor = 1.0 + random.uniform(-self.diff_limit, self.diff_limit)
-        im = ImageEnhance.Contrast(im).enhance(factor)
-        return np.copy(np.asarray(im))
+        return _blend(int(_grayscale(data).mean() + 0.5), data, factor)
 
 
 class Color(NumpyOp):
@@ -199,10 +239,8 @@ class Color(NumpyOp):
         self.diff_limit = level / 30 * 0.9
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
         factor = 1.0 + random.uniform(-self.diff_limit, self.diff_limit)
-        im = ImageEnhance.Color(im).enhance(factor)
-        return np.copy(np.asarray(im))
+        return _blend(_grayscale(data)[..., None], data, factor)
 
 
 class Brightness(NumpyOp):
@@ -211,78 +249,138 @@ class Brightness(NumpyOp):
         self.diff_limit = level / 30 * 0.9
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
         factor = 1.0 + random.uniform(-self.diff_limit, self.diff_limit)
-        im = ImageEnhance.Brightness(im).enhance(factor)
-        return np.copy(np.asarray(im))
+        return _blend(0.0, data, factor)
+
+
+class RUAChoice(NumpyOp):
+    """ pick one of the RUA options in every slot that fires, in a single op instead of one Sometimes(OneOf) per slot.
+    Pixel-level options are applied right away, geometric ones are only recorded and later applied batch-wise on GPU
+    by RandomAffine.
+
+    Args:
+        numpy_ops: pixel-level options, all taking and returning the image.
+        num_geometric: number of geometric options, see RandomAffine.
+        probs: probability of each slot firing.
+        inputs: key of the image.
+        outputs: keys of the image and of the geometric choice of every slot, 0 for none and 1 to num_geometric
+            otherwise.
+        mode: what mode(s) to execute this op in.
+    """
+    def __init__(self, *numpy_ops, num_geometric, probs, inputs=None, outputs=None, mode=None):
+        super().__init__(inputs=inputs, outputs=outputs, mode=mode)
+        self.numpy_ops = numpy_ops
+        self.num_geometric = num_geometric
+        self.probs = probs
 
+    def forward(self, data, state):
+        geometric = np.zeros(len(self.probs), dtype=np.int64)
+        for slot, prob in enumerate(self.probs):
+            if random.random() < prob:
+                choice = random.randrange(len(self.numpy_ops) + self.num_geometric)
+                if choice < len(self.numpy_ops):
+                    data = self.numpy_ops[choice].forward(data, state)
+                else:
+                    geometric[slot] = choice - len(self.numpy_ops) + 1
+        return data, geometric
+
+
+class RandomAffine(TensorOp):
+    """ rotate, shear or translate every sample as picked by RUAChoice for each slot, fused into a single bilinear
+    resample on GPU
+
+    Args:
+        level: augmentation level between 1 and 30.
+        fill: per-channel value of the pixels moved in from outside the image.
+        inputs: keys of the image batch and of the geometric choices from RUAChoice.
+        outputs: key of the transformed image batch.
+        mode: what mode(s) to execute this op in.
+    """
+    num_transforms = 5  # rotate, shear x, shear y, translate x, translate y
 
-class ShearX(NumpyOp):
-    def __init__(self, level, inputs=None, outputs=None, mode=None):
+    def __init__(self, level, fill, inputs=None, outputs=None, mode=None):
         super().__init__(inputs=inputs, outputs=outputs, mode=mode)
+        self.radian = level * 3.0 * math.pi / 180
         self.shear_coef = level / 30 * 0.5
+        self.translate_coef = level / 30 * 2 / 3  # a third of the image, in [-1, 1] grid units
+        self.fill = torch.tensor(fill).view(1, -1, 1, 1)
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
-        shear_coeff = random.uniform(-self.shear_coef, self.shear_coef)
-        width, height = im.size
-        xshift = round(abs(shear_coeff) * width)
-        new_width = width + xshift
-        im = im.transform((new_width, height),
-                          ImageTransform.AffineTransform(
-                              (1.0, shear_coeff, -xshift if shear_coeff > 0 else 0.0, 0.0, 1.0, 0.0)),
-                          resample=Image.BICUBIC)
-        im = im.resize((width, height))
-        return np.copy(np.asarray(im))
-
-
-class ShearY(NumpyOp):
-    def __init__(self, level, inputs=None, outputs=None, mode=None):
+        data, geometric = data
+        batch_size, device = data.shape[0], data.device
+        if self.fill.device != device:
+            self.fill = self.fill.to(device)
+        theta = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+        for slot in range(geometric.shape[1]):
+            theta = theta @ self._sample_matrix(geometric[:, slot], device)
+        grid = F.affine_grid(theta[:, :2], data.shape, align_corners=False)
+        # grid_sample pads with zeros, shift the image so that the padding becomes the fill value
+        return F.grid_sample(data - self.fill, grid, mode="bilinear", align_corners=False) + self.fill
+
+    def _sample_matrix(self, choice, device):
+        batch_size = choice.shape[0]
+        magnitude = torch.rand(batch_size, device=device) * 2 - 1
+        cos, sin = torch.cos(magnitude * self.radian), torch.sin(magnitude * self.radian)
+        shear, translate = magnitude * self.shear_coef, magnitude * self.translate_coef
+        # index 0 is the identity, for samples where the slot did not pick a geometric transform
+        candidates = torch.eye(3, device=device).repeat(batch_size, self.num_transforms + 1, 1, 1)
+        candidates[:, 1, :2, :2] = torch.stack([cos, -sin, sin, cos], dim=1).view(-1, 2, 2)
+        # shear as if onto a canvas widened by the shear and resized back, so the whole sheared image stays in view
+        candidates[:, 2, 0, 0], candidates[:, 2, 0, 1] = 1 + shear.abs(), shear
+        candidates[:, 3, 1, 1], candidates[:, 3, 1, 0] = 1 + shear.abs(), shear
+        candidates[:, 4, 0, 2] = translate
+        candidates[:, 5, 1, 2] = translate
+        return candidates[torch.arange(batch_size, device=device), choice]
+
+
+class GPUPreprocess(TensorOp):
+    """ turn the uint8 NHWC batch into a normalized float NCHW batch after it is copied to the device, so that the
+    host-to-device transfer stays in uint8
+    """
+    def __init__(self, mean, std, inputs=None, outputs=None, mode=None):
         super().__init__(inputs=inputs, outputs=outputs, mode=mode)
-        self.shear_coef = level / 30 * 0.5
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1) * 255
+        self.std = torch.tensor(std).view(1, -1, 1, 1) * 255
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
-        shear_coeff = random.uniform(-self.shear_coef, self.shear_coef)
-        width, height = im.size
-        yshift = round(abs(shear_coeff) * height)
-        newheight = height + yshift
-        im = im.transform((width, newheight),
-                          ImageTransform.AffineTransform(
-                              (1.0, 0.0, 0.0, shear_coeff, 1.0, -yshift if shear_coeff > 0 else 0.0)),
-                          resample=Image.BICUBIC)
-        im = im.resize((width, height))
-        return np.copy(np.asarray(im))
-
-
-class TranslateX(NumpyOp):
-    def __init__(self, level, inputs=None, outputs=None, mode=None):
-        super().__init__(inputs=inputs, outputs=outputs, mode=mode)
-        self.level = level
+        if self.mean.device != data.device:
+            self.mean, self.std = self.mean.to(data.device), self.std.to(data.device)
+        data = data.permute(0, 3, 1, 2).float()
+        return (data - self.mean) / self.std
+
 
+class GPUHorizontalFlip(TensorOp):
+    """ flip every sample with 50% chance using one mask for the whole batch, same as Sometimes(HorizontalFlip)
+    """
     def forward(self, data, state):
-        im = Image.fromarray(data)
-        width, height = im.size
-        displacement = random.uniform(-self.level / 30 * height / 3, self.level / 30 * height / 3)
-        im = im.transform((width, height),
-                          ImageTransform.AffineTransform((1.0, 0.0, displacement, 0.0, 1.0, 0.0)),
-                          resample=Image.BICUBIC)
-        return np.copy(np.asarray(im))
+        flip = torch.rand(data.shape[0], device=data.device) < 0.5
+        return torch.where(flip.view(-1, 1, 1, 1), data.flip(-1), data)
 
 
-class TranslateY(NumpyOp):
-    def __init__(self, level, inputs=None, outputs=None, mode=None):
+class GPUCoarseDropout(TensorOp):
+    """ zero out one random hole per sample, same as CoarseDropout(max_holes=1) with its default 8x8 hole
+    """
+    def __init__(self, hole_size=8, inputs=None, outputs=None, mode=None):
         super().__init__(inputs=inputs, outputs=outputs, mode=mode)
-        self.level = level
+        self.hole_size = hole_size
 
     def forward(self, data, state):
-        im = Image.fromarray(data)
-        width, height = im.size
-        displacement = random.uniform(-self.level / 30 * height / 3, self.level / 30 * height / 3)
-        im = im.transform((width, height),
-                          ImageTransform.AffineTransform((1.0, 0.0, 0.0, 0.0, 1.0, displacement)),
-                          resample=Image.BICUBIC)
-        return np.copy(np.asarray(im))
+        batch_size, _, height, width = data.shape
+        device = data.device
+        top = torch.randint(height - self.hole_size + 1, (batch_size, 1, 1), device=device)
+        left = torch.randint(width - self.hole_size + 1, (batch_size, 1, 1), device=device)
+        rows = torch.arange(height, device=device).view(1, -1, 1)
+        cols = torch.arange(width, device=device).view(1, 1, -1)
+        hole = (rows >= top) & (rows < top + self.hole_size) & (cols >= left) & (cols < left + self.hole_size)
+        return data.masked_fill(hole.unsqueeze(1), 0.0)
+
+
+def load_cifar10():
+    (x_train, y_train), (x_eval, y_eval) = tf.keras.datasets.cifar10.load_data()
+    # one contiguous uint8 block per split, every sample handed to the pipeline is a view into it
+    train_data = NumpyDataset({"x": np.ascontiguousarray(x_train, dtype=np.uint8), "y": y_train})
+    eval_data = NumpyDataset({"x": np.ascontiguousarray(x_eval, dtype=np.uint8), "y": y_eval})
+    return train_data, eval_data
 
 
 def get_N(level, N_max, N_min=1):
@@ -293,9 +391,8 @@ def get_N(level, N_max, N_min=1):
 def get_estimator(level=18, epochs=200, batch_size=128, save_dir=tempfile.mkdtemp(), restore_dir=tempfile.mkdtemp()):
     print("trying level {}".format(level))
     # step 1: prepare dataset
-    train_data, eval_data = cifar10.load_data()
+    train_data, eval_data = load_cifar10()
     aug_options = [
-        Rotate(level=level, inputs="x", outputs="x", mode="train"),
         Identity(level=level, inputs="x", outputs="x", mode="train"),
         AutoContrast(level=level, inputs="x", outputs="x", mode="train"),
         Equalize(level=level, inputs="x", outputs="x", mode="train"),
@@ -304,34 +401,41 @@ def get_estimator(level=18, epochs=200, batch_size=128, save_dir=tempfile.mkdtem
         Sharpness(level=level, inputs="x", outputs="x", mode="train"),
         Contrast(level=level, inputs="x", outputs="x", mode="train"),
         Color(level=level, inputs="x", outputs="x", mode="train"),
-        Brightness(level=level, inputs="x", outputs="x", mode="train"),
-        ShearX(level=level, inputs="x", outputs="x", mode="train"),
-        ShearY(level=level, inputs="x", outputs="x", mode="train"),
-        TranslateX(level=level, inputs="x", outputs="x", mode="train"),
-        TranslateY(level=level, inputs="x", outputs="x", mode="train")
+        Brightness(level=level, inputs="x", outputs="x", mode="train")
     ]
-    N_guarantee, N_p = get_N(level, N_max=min(len(aug_options), 5))
-    rua_ops = [OneOf(*aug_options) for _ in range(N_guarantee)]
-    if N_p > 0:
-        rua_ops.append(Sometimes(OneOf(*aug_options), prob=N_p))
+    N_guarantee, N_p = get_N(level, N_max=min(len(aug_options) + RandomAffine.num_transforms, 5))
+    # the geometric options are picked here as well, but applied batch-wise on GPU by RandomAffine
+    rua_op = RUAChoice(*aug_options,
+                       num_geometric=RandomAffine.num_transforms,
+                       probs=[1.0] * N_guarantee + ([N_p] if N_p > 0 else []),
+                       inputs="x",
+                       outputs=("x", "geometric"),
+                       mode="train")
+    mean, std = (0.4914, 0.4822, 0.4465), (0.2471, 0.2435, 0.2616)
     pipeline = fe.Pipeline(
         train_data=train_data,
         eval_data=eval_data,
         batch_size=batch_size,
+        num_process=min(8, os.cpu_count()),
         ops=[
             PadIfNeeded(min_height=40, min_width=40, image_in="x", image_out="x", mode="train"),
             RandomCrop(32, 32, image_in="x", image_out="x", mode="train"),
-            Sometimes(HorizontalFlip(image_in="x", image_out="x", mode="train"))
-        ] + rua_ops + [
-            Normalize(inputs="x", outputs="x", mean=(0.4914, 0.4822, 0.4465), std=(0.2471, 0.2435, 0.2616)),
-            CoarseDropout(inputs="x", outputs="x", mode="train", max_holes=1),
-            ChannelTranspose(inputs="x", outputs="x")
+            rua_op
         ])
     # step 2: prepare network
-    model = fe.build(model_fn=lambda: WideResNet(depth=28, num_classes=10, widen_factor=10),
-                     optimizer_fn=lambda x: torch.optim.SGD(x, lr=0.1, momentum=0.9, weight_decay=0.0005))
+    model = fe.build(model_fn=lambda: compile_model(WideResNet(depth=28, num_classes=10, widen_factor=10)),
+                     optimizer_fn=lambda x: torch.optim.SGD(x, lr=0.1, momentum=0.9, weight_decay=0.0005),
+                     mixed_precision=True)
 
     network = fe.Network(ops=[
+        GPUPreprocess(inputs="x", outputs="x", mean=mean, std=std),
+        GPUHorizontalFlip(inputs="x", outputs="x", mode="train"),
+        RandomAffine(level=level,
+                     fill=[-m / s for m, s in zip(mean, std)],
+                     inputs=("x", "geometric"),
+                     outputs="x",
+                     mode="train"),
+        GPUCoarseDropout(inputs="x", outputs="x", mode="train"),
         ModelOp(model=model, inputs="x", outputs="y_pred"),
         CrossEntropy(inputs=("y_pred", "y"), outputs="ce", from_logits=True),
         UpdateOp(model=model, loss_name="ce")